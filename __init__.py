@@ -1,22 +1,24 @@
 import asyncio
+from collections import defaultdict
 from functools import partial
 import logging
-import types
 
 import voluptuous as vol
 
 from homeassistant.const import (
-    EVENT_STATE_CHANGED,
     STATE_ON,
-    EVENT_CALL_SERVICE,
     EVENT_SERVICE_REGISTERED,
 )
 from homeassistant.components.light import (
     LIGHT_TURN_ON_SCHEMA,
     preprocess_turn_on_alternatives,
 )
-from homeassistant.core import callback, ServiceCall
+from homeassistant.core import ServiceCall
 import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.config_validation import (
+    ENTITY_SERVICE_FIELDS as _ENTITY_SERVICE_FIELDS,
+)
+from homeassistant.helpers.event import async_track_state_change_event
 
 DOMAIN = "light_presets"
 
@@ -28,7 +30,7 @@ CONFIG_SCHEMA = vol.Schema(
             vol.All(
                 {
                     "preset": cv.string,
-                    "presets": cv.schema_with_slug_keys(dict),
+                    "presets": cv.schema_with_slug_keys({cv.string: dict}),
                     "lights": vol.All(cv.ensure_list, [cv.string]),
                 }
             )
@@ -38,71 +40,92 @@ CONFIG_SCHEMA = vol.Schema(
     extra=vol.ALLOW_EXTRA,
 )
 
-LIGHT_ATTRIBUTES = (
-    "brightness",
-    "kelvin",
-    "rgb_color",
-    "white_value",
-    "color_temp",
-    "color_name",
-    "brightness_pct",
-    "effect",
-    "hs_color",
+LIGHT_ATTRIBUTES = frozenset(
+    {
+        "brightness",
+        "kelvin",
+        "rgb_color",
+        "white_value",
+        "color_temp",
+        "color_name",
+        "brightness_pct",
+        "effect",
+        "hs_color",
+    }
+)
+
+COLOR_ATTRIBUTES = frozenset(
+    {
+        "kelvin",
+        "rgb_color",
+        "white_value",
+        "color_temp",
+        "color_name",
+        "hs_color",
+    }
 )
 
-COLOR_ATTRIBUTES = (
-    "kelvin",
-    "rgb_color",
-    "white_value",
-    "color_temp",
-    "color_name",
-    "hs_color",
+LIGHT_TURN_ON_OVERRIDE_SCHEMA = cv.make_entity_service_schema(
+    LIGHT_TURN_ON_SCHEMA, extra=vol.ALLOW_EXTRA
 )
 
 DEFAULT_STATE = "on_if_anything_on"
 
-def async_partial(func, *args, **kwargs):
-    return asyncio.coroutine(partial(func, *args, **kwargs))
+EMPTY_SETTINGS = {
+    "attributes": {},
+    "meta": {"state": DEFAULT_STATE, "update_if_off": False},
+}
 
+def _bind(func, *bound):
+    async def _inner(call):
+        return await func(*bound, call)
 
-@asyncio.coroutine
-def async_setup(hass, config):
+    return _inner
+
+
+async def async_setup(hass, config):
     light_groups = LightGroupsConfig(config[DOMAIN])
 
-    hass.bus.async_listen(
-        EVENT_SERVICE_REGISTERED, partial(on_service_registered, hass, light_groups),
-    )
+    if hass.services.has_service("light", "turn_on"):
+        register_light_override(hass, light_groups)
+    else:
+        unsub = hass.bus.async_listen(
+            EVENT_SERVICE_REGISTERED,
+            partial(on_service_registered, hass, light_groups, lambda: unsub()),
+        )
 
-    hass.bus.async_listen(
-        EVENT_STATE_CHANGED, partial(on_state_changed, hass, light_groups),
+    async_track_state_change_event(
+        hass,
+        light_groups.get_preset_ids(),
+        partial(on_state_changed, hass, light_groups),
     )
 
     hass.services.async_register(
-        DOMAIN, "light_on", async_partial(service_light_on, hass, light_groups)
+        DOMAIN, "light_on", _bind(service_light_on, hass, light_groups)
     )
     hass.services.async_register(
-        DOMAIN, "light_off", async_partial(service_light_off, hass, light_groups)
+        DOMAIN, "light_off", _bind(service_light_off, hass, light_groups)
     )
     hass.services.async_register(
-        DOMAIN, "light_toggle", async_partial(service_light_toggle, hass, light_groups)
+        DOMAIN, "light_toggle", _bind(service_light_toggle, hass, light_groups)
     )
 
     return True
 
 
 async def service_light_on(hass, light_groups, call):
-    _LOGGER.info("Light on", call.data)
+    _LOGGER.debug("Light on %s", call.data)
 
     group_name = call.data["light_group"]
     group = light_groups.get_group_by_name(group_name)
 
     _LOGGER.debug("Lights %s", group["lights"])
 
-    await group_lights_turn_on(hass, group, call.data)
+    await group_lights_turn_on(hass, light_groups, group, call.data, call.context)
 
 
 async def service_light_off(hass, light_groups, call):
-    _LOGGER.info("Light off %s", call.data)
+    _LOGGER.debug("Light off %s", call.data)
 
     group_name = call.data["light_group"]
     group = light_groups.get_group_by_name(group_name)
@@ -111,7 +134,7 @@ async def service_light_off(hass, light_groups, call):
 
 
 async def service_light_toggle(hass, light_groups, call):
-    _LOGGER.info("Light toggle %s", call.data)
+    _LOGGER.debug("Light toggle %s", call.data)
 
     group_name = call.data["light_group"]
     group = light_groups.get_group_by_name(group_name)
@@ -121,51 +144,63 @@ async def service_light_toggle(hass, light_groups, call):
     if anything_on:
         await group_lights_turn_off(hass, group)
     else:
-        await group_lights_turn_on(hass, group)
+        await group_lights_turn_on(hass, light_groups, group, context=call.context)
 
 
 async def on_state_changed(hass, light_groups, event):
     groups = light_groups.get_group_by_preset_id(event.data.get("entity_id"),)
 
     if groups and event.data.get("old_state"):
-        _LOGGER.info("preset changed event %s", event)
+        _LOGGER.debug("preset changed event %s", event)
         for group in groups:
-            _LOGGER.info("Updating group %s", group["id"])
-            await group_lights_update(hass, group)
+            _LOGGER.debug("Updating group %s", group["id"])
+            await group_lights_update(hass, light_groups, group, event.context)
 
 
 _light_override_registered = False
 
 
-async def on_service_registered(hass, light_groups, event):
-    global _light_override_registered
+async def on_service_registered(hass, light_groups, unsubscribe, event):
+    # Registering the override fires this event again, while the listener
+    # is still subscribed. That second call must not unsubscribe again.
+    if _light_override_registered:
+        return
 
     if (
         event.data.get("domain") == "light"
         and event.data.get("service") == "turn_on"
-        and _light_override_registered is False
+        and register_light_override(hass, light_groups)
     ):
-        services = hass.services.async_services()
-        try:
-            light_turn_on = services["light"]["turn_on"]
-        except KeyError:
-            _LOGGER.warning("Light service not found, not overriding")
-            return
-
-        override = async_partial(turn_on_override, hass, light_groups, light_turn_on)
-
-        hass.services.async_remove("light", "turn_on")
-        _LOGGER.debug("Removed light service")
-        _light_override_registered = True
-        hass.services.async_register(
-            "light",
-            "turn_on",
-            override,
-            schema=cv.make_entity_service_schema(
-                LIGHT_TURN_ON_SCHEMA, extra=vol.ALLOW_EXTRA
-            ),
-        )
-        _LOGGER.debug("Registered light service override")
+        unsubscribe()
+
+
+def register_light_override(hass, light_groups):
+    global _light_override_registered
+
+    if _light_override_registered:
+        return True
+
+    services = hass.services.async_services()
+    try:
+        light_turn_on = services["light"]["turn_on"]
+    except KeyError:
+        _LOGGER.warning("Light service not found, not overriding")
+        return False
+
+    override = _bind(turn_on_override, hass, light_groups, light_turn_on)
+    light_groups.light_turn_on_target = light_turn_on.job.target
+
+    hass.services.async_remove("light", "turn_on")
+    _LOGGER.debug("Removed light service")
+    _light_override_registered = True
+    hass.services.async_register(
+        "light",
+        "turn_on",
+        override,
+        schema=LIGHT_TURN_ON_OVERRIDE_SCHEMA,
+    )
+    _LOGGER.debug("Registered light service override")
+    return True
 
 
 async def turn_on_override(hass, light_groups, light_turn_on, event):
@@ -179,91 +214,170 @@ async def turn_on_override(hass, light_groups, light_turn_on, event):
 
     group = light_groups.get_group_by_light(light)
 
-    has_custom_attributes = any(attr in event.data for attr in LIGHT_ATTRIBUTES)
+    has_custom_attributes = not LIGHT_ATTRIBUTES.isdisjoint(event.data)
 
     if group and not has_custom_attributes:
-        settings = get_light_settings(hass, group, light)
+        settings = get_light_settings(group, get_preset_state(hass, group), light)
         attributes = settings["attributes"]
 
         _LOGGER.debug("Adding turn on default attributes %s", attributes)
 
+        # Only defaults are added here, explicit service data always wins.
         event_data = {
-            **event.data,
             **attributes,
+            **event.data,
         }
         _LOGGER.debug("New event attributes %s", event_data)
 
     else:
-        event_data = event.data
+        event_data = {**event.data}
 
     event = ServiceCall(
         domain=event.domain,
         service=event.service,
-        data=preprocess_data(hass, {**event_data}),
+        data=preprocess_data(hass, event_data),
         context=event.context,
     )
 
     await light_turn_on.job.target(event)
 
 
-async def group_lights_update(hass, group):
+async def group_lights_update(hass, light_groups, group, context=None):
+    preset_state = get_preset_state(hass, group)
+    if preset_state is None:
+        _LOGGER.warning("Preset %s not found, not updating lights", group["preset"])
+        return
+
     anything_on = is_anything_on(hass, group)
+    log_debug = _LOGGER.isEnabledFor(logging.DEBUG)
+    coros = []
 
     for light in group["lights"]:
-        settings = get_light_settings(hass, group, light)
+        settings = get_light_settings(group, preset_state, light)
         attributes = settings["attributes"]
         meta = settings["meta"]
 
-        _LOGGER.debug("Updating light %s using settings %s", light, settings)
+        if log_debug:
+            _LOGGER.debug("Updating light %s using settings %s", light, settings)
 
         if is_light_on(hass, light):
             if meta["state"] == "off":
-                await turn_off_light(hass, light)
+                coros.append(turn_off_light(hass, light, context))
             else:
-                await turn_on_light(hass, light, attributes)
+                coros.append(
+                    turn_on_light(hass, light_groups, light, attributes, context)
+                )
         elif meta["state"] == "on" or (
             meta["state"] == "on_if_anything_on" and anything_on
         ):
-            await turn_on_light(hass, light, attributes)
+            coros.append(
+                turn_on_light(hass, light_groups, light, attributes, context)
+            )
         elif meta["state"] == "no_change":
             if meta["update_if_off"] == "flicker":
-                _LOGGER.debug("Light flicker on %s using settings %s", light, attributes)
-                await turn_on_light(hass, light, attributes)
-                await asyncio.sleep(3)
-                _LOGGER.debug("Light flicker off %s using settings %s", light, attributes)
-                await turn_off_light(hass, light)
+                coros.append(
+                    flicker_light(hass, light_groups, light, attributes, context)
+                )
+
+    if coros:
+        await gather_light_calls(coros)
+
 
+async def group_lights_turn_on(
+    hass, light_groups, group, service_params={}, context=None
+):
+    preset_state = get_preset_state(hass, group)
+    if preset_state is None:
+        _LOGGER.warning("Preset %s not found, not turning on lights", group["preset"])
+        return
+
+    buckets = {}
 
-async def group_lights_turn_on(hass, group, service_params={}):
     for light in group["lights"]:
-        settings = get_light_settings(hass, group, light)
+        settings = get_light_settings(group, preset_state, light)
         attributes = settings["attributes"]
         meta = settings["meta"]
 
+        if meta["state"] == "off":
+            continue
+
         if 'preset_brightness_pct' in service_params:
+            attributes = {**attributes}
             attributes['brightness'] = attributes.get('brightness', 255) * service_params['preset_brightness_pct'] / 100
 
-        if meta["state"] != "off":
-            await turn_on_light(hass, light, attributes)
+        key = freeze_attributes(attributes)
+        if key not in buckets:
+            buckets[key] = (attributes, [])
+        buckets[key][1].append(light)
+
+    if buckets:
+        await gather_light_calls(
+            turn_on_light(hass, light_groups, lights, attributes, context)
+            for attributes, lights in buckets.values()
+        )
+
+
+async def gather_light_calls(coros):
+    """Run light calls concurrently so that one failing light does not stop the rest."""
+    results = await asyncio.gather(*coros, return_exceptions=True)
+
+    for result in results:
+        if isinstance(result, Exception):
+            _LOGGER.error("Error updating light", exc_info=result)
 
 
 async def group_lights_turn_off(hass, group):
     await hass.services.async_call("light", "turn_off", {"entity_id": group["lights"],})
 
 
-async def turn_on_light(hass, light, attributes):
+async def turn_on_light(hass, light_groups, light, attributes, context=None):
     _LOGGER.debug("turn on attributes %s", attributes)
+    data = {"entity_id": light, **attributes}
+    light_turn_on_target = light_groups.light_turn_on_target
+
+    if light_turn_on_target is None:
+        await hass.services.async_call("light", "turn_on", data, context=context)
+        return
+
+    # Call the original light handler directly, skipping the service bus
+    # and our own override.
+    call = ServiceCall(
+        domain="light",
+        service="turn_on",
+        data=preprocess_data(hass, LIGHT_TURN_ON_OVERRIDE_SCHEMA(data)),
+        context=context,
+    )
+    await light_turn_on_target(call)
+
+
+async def turn_off_light(hass, light, context=None):
     await hass.services.async_call(
-        "light", "turn_on", {"entity_id": light, **attributes,}
+        "light", "turn_off", {"entity_id": light,}, context=context
     )
 
 
-async def turn_off_light(hass, light):
-    await hass.services.async_call("light", "turn_off", {"entity_id": light,})
+async def flicker_light(hass, light_groups, light, attributes, context=None):
+    _LOGGER.debug("Light flicker on %s using settings %s", light, attributes)
+    await turn_on_light(hass, light_groups, light, attributes, context)
+    await asyncio.sleep(3)
+    _LOGGER.debug("Light flicker off %s using settings %s", light, attributes)
+    await turn_off_light(hass, light, context)
+
+
+def freeze_attributes(attributes):
+    """Return a hashable key for light attributes, eg. to batch service calls."""
+    return frozenset(
+        (k, tuple(v) if isinstance(v, list) else v) for k, v in attributes.items()
+    )
 
 
 def is_anything_on(hass, group):
-    return any(is_light_on(hass, light) for light in group["lights"])
+    get_state = hass.states.get
+    return any(
+        (state := get_state(light)) is not None and state.state == STATE_ON
+        for light in group["lights"]
+    )
+
 
 def is_light_on(hass, light):
     light_state = hass.states.get(light)
@@ -271,16 +385,22 @@ def is_light_on(hass, light):
     return light_state and light_state.state == STATE_ON
 
 
+def get_preset_state(hass, group):
+    state = hass.states.get(group["preset"])
+    return state.state.lower() if state else None
+
+
 def get_group_attributes(hass, group):
-    selected_preset = hass.states.get(group["preset"]).state
-    return group["presets"].get(selected_preset.lower(), {}).get("defaults")
+    preset_state = get_preset_state(hass, group)
+    return group["presets"].get(preset_state, {}).get("defaults")
 
 
-def get_light_settings(hass, group, entity_id):
-    selected_preset = hass.states.get(group["preset"]).state
+def get_light_settings(group, preset_state, entity_id):
+    """Return precomputed settings for a light, which must not be mutated."""
+    return group["settings"].get((preset_state, entity_id), EMPTY_SETTINGS)
 
-    preset = group["presets"].get(selected_preset.lower(), {})
 
+def compute_light_settings(preset, entity_id):
     defaults = preset.get("defaults", {})
     overrides = preset.get(entity_id, {})
 
@@ -297,8 +417,11 @@ def get_light_settings(hass, group, entity_id):
     }
 
 
+def sets_color(attributes):
+    return not COLOR_ATTRIBUTES.isdisjoint(attributes)
+
+
 def merge_light_attributes(defaults, overrides):
-    sets_color = lambda attr: len(set(attr.keys()) & set(COLOR_ATTRIBUTES)) > 0
     if sets_color(defaults) and sets_color(overrides):
         defaults = {k: v for (k, v) in defaults.items() if k not in COLOR_ATTRIBUTES}
 
@@ -307,34 +430,44 @@ def merge_light_attributes(defaults, overrides):
 
 class LightGroupsConfig:
     def __init__(self, config):
+        self._by_preset = defaultdict(list)
+        self._by_light = {}
+
         for id, group in config.items():
             group["id"] = id
+            group["settings"] = {
+                (preset_name, entity_id): compute_light_settings(preset, entity_id)
+                for preset_name, preset in group["presets"].items()
+                for entity_id in group["lights"]
+            }
+            self._by_preset[group["preset"]].append(group)
+            for light in group["lights"]:
+                self._by_light.setdefault(light, group)
 
         self._config = config
+        self.light_turn_on_target = None
+
+    def get_preset_ids(self):
+        return list(self._by_preset)
 
     def get_group_by_preset_id(self, entity_id):
-        return [
-            group for id, group in self._config.items() if group["preset"] == entity_id
-        ]
+        return self._by_preset.get(entity_id, ())
 
     def get_group_by_name(self, name):
-        return next((group for id, group in self._config.items() if id == name), None,)
+        return self._config.get(name)
 
     def get_group_by_light(self, light):
-        for group in self._config.values():
-            if light in group["lights"]:
-                return group
+        return self._by_light.get(light)
 
 """
 Copied from light service
 """
 def preprocess_data(hass, data):
-    """Preprocess the service data."""
-    base = {
-        entity_field: data.pop(entity_field)
-        for entity_field in cv.ENTITY_SERVICE_FIELDS
-        if entity_field in data
-    }
+    """Preprocess the service data, modifying data in place."""
+    base = {}
+    for entity_field in _ENTITY_SERVICE_FIELDS:
+        if entity_field in data:
+            base[entity_field] = data.pop(entity_field)
 
     preprocess_turn_on_alternatives(hass, data)
     base["params"] = data